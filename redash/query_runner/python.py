@@ -1,27 +1,71 @@
 import datetime
+import decimal
 import importlib
+import functools
 import logging
+import numbers
+import operator
 import sys
+import time
 import pystache
-from funcy import distinct
 
 from redash.query_runner import *
-from redash.utils import json_dumps, json_loads, mustache_render
+from redash.utils import JSONEncoder, json_dumps, json_loads, mustache_render
 from redash import models
 from RestrictedPython import compile_restricted
 from RestrictedPython.Guards import safe_builtins, guarded_iter_unpack_sequence, guarded_unpack_sequence
 
 try:
     import pandas as pd
-    import numpy as np
     pandas_installed = True
 except ImportError:
     pandas_installed = False
 
-from RestrictedPython.transformer import IOPERATOR_TO_STR
+try:
+    import orjson
+    orjson_installed = True
+except ImportError:
+    orjson_installed = False
 
 logger = logging.getLogger(__name__)
 
+_NOT_ALLOWED = object()
+
+_INPLACE_OPS = {
+    "+=": operator.iadd,
+    "-=": operator.isub,
+    "*=": operator.imul,
+    "/=": operator.itruediv,
+    "//=": operator.ifloordiv,
+    "%=": operator.imod,
+    "**=": operator.ipow,
+    "&=": operator.iand,
+    "|=": operator.ior,
+    "^=": operator.ixor,
+    "<<=": operator.ilshift,
+    ">>=": operator.irshift,
+    "@=": operator.imatmul,
+}
+
+_KIND_TO_TYPE = {
+    "b": TYPE_BOOLEAN,
+    "f": TYPE_FLOAT,
+    "i": TYPE_INTEGER,
+    "u": TYPE_INTEGER,
+    "M": TYPE_DATETIME,
+    "O": TYPE_STRING,
+    "U": TYPE_STRING,
+    "S": TYPE_STRING,
+}
+
+def _get_data_source(data_source_name_or_id):
+    """Load a data source by id (any integral number) or by name."""
+    if isinstance(data_source_name_or_id, numbers.Integral) and not isinstance(
+        data_source_name_or_id, bool
+    ):
+        return models.DataSource.get_by_id(int(data_source_name_or_id))
+    return models.DataSource.get_by_name(data_source_name_or_id)
+
 def get_query(query_id):
     try:
         query = models.Query.get_by_id(query_id)
@@ -29,21 +73,58 @@ def get_query(query_id):
         raise Exception("Query id %s does not exist." % query_id)
     return query
 
-def _collect_key_names(nodes):
+def _collect_key_names(root):
     keys = []
-    for node in nodes._parse_tree:
-        if isinstance(node, pystache.parser._EscapeNode):
-            keys.append(node.key)
-        elif isinstance(node, pystache.parser._SectionNode):
-            keys.append(node.key)
-            keys.extend(_collect_key_names(node.parsed))
-
-    return distinct(keys)
-
+    stack = [root]
+    while stack:
+        nodes = stack.pop()
+        for node in nodes._parse_tree:
+            if isinstance(node, pystache.parser._EscapeNode):
+                keys.append(node.key)
+            elif isinstance(node, pystache.parser._SectionNode):
+                keys.append(node.key)
+                stack.append(node.parsed)
+
+    return frozenset(keys)
+
+@functools.lru_cache(maxsize=1024)
 def _collect_query_parameters(query):
     nodes = pystache.parse(query)
-    keys = _collect_key_names(nodes)
-    return keys
+    return _collect_key_names(nodes)
+
+_json_encoder = JSONEncoder()
+
+def _orjson_default(o):
+    # orjson can't write Decimals exactly, raising here hands the whole
+    # payload back to json_dumps, which does.
+    if isinstance(o, decimal.Decimal):
+        raise TypeError("Decimal is serialized by json_dumps")
+    return _json_encoder.default(o)
+
+def _dumps_result(result):
+    """Serialize a script result, with orjson when it is installed.
+
+    orjson only encodes plain JSON types itself. Dates and times are handed
+    to JSONEncoder, and anything else it would treat differently from
+    json_dumps (Decimals, numpy values, non-string keys, ints wider than
+    64 bits) makes the whole result fall back to json_dumps. Both paths
+    produce the same document; orjson's output is just compact and keeps
+    non-ASCII characters unescaped."""
+    if orjson_installed:
+        try:
+            return orjson.dumps(
+                result,
+                default=_orjson_default,
+                option=orjson.OPT_PASSTHROUGH_DATETIME,
+            ).decode()
+        except orjson.JSONEncodeError:
+            pass
+
+    return json_dumps(result)
+
+@functools.lru_cache(maxsize=256)
+def _compile_restricted_cached(source):
+    return compile_restricted(source, "<string>", "exec")
 
 
 class CustomPrint(object):
@@ -56,10 +137,19 @@ class CustomPrint(object):
     def write(self, text):
         if self.enabled:
             if text and text.strip():
-                log_line = "[{0}] {1}".format(
-                    datetime.datetime.utcnow().isoformat(), text
-                )
-                self.lines.append(log_line)
+                self.lines.append((time.monotonic_ns(), text))
+
+    def get_lines(self):
+        """Render the collected lines, timestamping them all in one pass."""
+        now = datetime.datetime.utcnow()
+        now_ns = time.monotonic_ns()
+        return [
+            "[{0}] {1}".format(
+                (now - datetime.timedelta(microseconds=(now_ns - ns) // 1000)).isoformat(),
+                text,
+            )
+            for ns, text in self.lines
+        ]
 
     def enable(self):
         self.enabled = True
@@ -123,13 +213,16 @@ class Python(BaseQueryRunner):
     def enabled(cls):
         return True
 
+    @classmethod
+    def clear_cache(cls):
+        _compile_restricted_cached.cache_clear()
+
     def __init__(self, configuration):
         super(Python, self).__init__(configuration)
 
         self.syntax = "python"
 
         self._allowed_modules = {}
-        self._script_locals = {"result": {"rows": [], "columns": [], "log": []}}
         self._enable_print_log = True
         self._custom_print = CustomPrint()
 
@@ -142,25 +235,83 @@ class Python(BaseQueryRunner):
                 if p not in sys.path:
                     sys.path.append(p)
 
+        self._safe_builtins = set(self.safe_builtins)
         if self.configuration.get("additionalBuiltins", None):
             for b in self.configuration["additionalBuiltins"].split(","):
-                if b not in self.safe_builtins:
-                    self.safe_builtins += (b, )
+                b = b.strip()
+                if b:
+                    self._safe_builtins.add(b)
+
+        self._builtins_template = None
+
+        restricted_globals = {}
+        restricted_globals["get_query_result"] = self.get_query_result
+        restricted_globals["get_source_schema"] = self.get_source_schema
+        restricted_globals["get_current_user"] = self.get_current_user
+        restricted_globals["execute_query"] = self.execute_query
+        restricted_globals["execute_by_query_id"] = self.execute_by_query_id
+        restricted_globals["add_result_column"] = self.add_result_column
+        if pandas_installed:
+            restricted_globals["dataframe_to_result"] = self.dataframe_to_result
+        restricted_globals["add_result_row"] = self.add_result_row
+        restricted_globals["add_result_rows"] = self.add_result_rows
+        restricted_globals["disable_print_log"] = self._custom_print.disable
+        restricted_globals["enable_print_log"] = self._custom_print.enable
+
+        # Supported data types
+        restricted_globals["TYPE_DATETIME"] = TYPE_DATETIME
+        restricted_globals["TYPE_BOOLEAN"] = TYPE_BOOLEAN
+        restricted_globals["TYPE_INTEGER"] = TYPE_INTEGER
+        restricted_globals["TYPE_STRING"] = TYPE_STRING
+        restricted_globals["TYPE_DATE"] = TYPE_DATE
+        restricted_globals["TYPE_FLOAT"] = TYPE_FLOAT
+
+        self._restricted_globals_template = restricted_globals
+
+    def _get_builtins_template(self):
+        """Build the script builtins on first use.
+
+        Runners are also created just to list or test data sources, so the
+        template and the additionalBuiltins check wait for run_query."""
+        if self._builtins_template is None:
+            builtins = safe_builtins.copy()
+            builtins["_write_"] = self.custom_write
+            builtins["__import__"] = self.custom_import
+            builtins["_getattr_"] = getattr
+            builtins["getattr"] = getattr
+            builtins["_setattr_"] = setattr
+            builtins["setattr"] = setattr
+            builtins["_getitem_"] = self.custom_get_item
+            builtins["_getiter_"] = self.custom_get_iter
+            builtins["_print_"] = self._custom_print
+            builtins["_unpack_sequence_"] = guarded_unpack_sequence
+            builtins["_iter_unpack_sequence_"] = guarded_iter_unpack_sequence
+            builtins["_inplacevar_"] = self.custom_inplacevar
+
+            # Layer in our own additional set of builtins that we have
+            # considered safe.
+            for key in self._safe_builtins:
+                if key not in __builtins__:
+                    logger.warning("Ignoring unknown builtin '%s' in additionalBuiltins", key)
+                    continue
+                builtins[key] = __builtins__[key]
+
+            self._builtins_template = builtins
+
+        return self._builtins_template
 
     def custom_import(self, name, globals=None, locals=None, fromlist=(), level=0):
-        if name in self._allowed_modules:
-            m = None
-            if self._allowed_modules[name] is None:
-                m = importlib.import_module(name)
-                self._allowed_modules[name] = m
-            else:
-                m = self._allowed_modules[name]
+        m = self._allowed_modules.get(name, _NOT_ALLOWED)
+        if m is _NOT_ALLOWED:
+            raise Exception(
+                "'{0}' is not configured as a supported import module".format(name)
+            )
 
-            return m
+        if m is None:
+            m = sys.modules.get(name) or importlib.import_module(name)
+            self._allowed_modules[name] = m
 
-        raise Exception(
-            "'{0}' is not configured as a supported import module".format(name)
-        )
+        return m
 
     @staticmethod
     def custom_write(obj):
@@ -180,11 +331,10 @@ class Python(BaseQueryRunner):
 
     @staticmethod
     def custom_inplacevar(op, x, y):
-        if op not in IOPERATOR_TO_STR.values():
+        fn = _INPLACE_OPS.get(op)
+        if fn is None:
             raise Exception("'{} is not supported inplace variable'".format(op))
-        glb = {"x": x, "y": y}
-        exec("x" + op + "y", glb)
-        return glb["x"]
+        return fn(x, y)
 
     @staticmethod
     def add_result_column(result, column_name, friendly_name, column_type):
@@ -219,6 +369,19 @@ class Python(BaseQueryRunner):
 
         result["rows"].append(values)
 
+    @staticmethod
+    def add_result_rows(result, values_list):
+        """Helper function to add several rows to results set at once.
+
+        Parameters:
+        :result dict: The result dict
+        :values_list list: Rows of result, each one a dict as accepted by add_result_row.
+        """
+        if "rows" not in result:
+            result["rows"] = []
+
+        result["rows"].extend(values_list)
+
     @staticmethod
     def execute_query(data_source_name_or_id, query, result_type=None):
         """Run query from specific data source.
@@ -228,10 +391,7 @@ class Python(BaseQueryRunner):
         :query string: Query to run
         """
         try:
-            if type(data_source_name_or_id) == int:
-                data_source = models.DataSource.get_by_id(data_source_name_or_id)
-            else:
-                data_source = models.DataSource.get_by_name(data_source_name_or_id)
+            data_source = _get_data_source(data_source_name_or_id)
         except models.NoResultFound:
             raise Exception("Wrong data source name/id: %s." % data_source_name_or_id)
 
@@ -257,10 +417,7 @@ class Python(BaseQueryRunner):
         :return:
         """
         try:
-            if type(data_source_name_or_id) == int:
-                data_source = models.DataSource.get_by_id(data_source_name_or_id)
-            else:
-                data_source = models.DataSource.get_by_name(data_source_name_or_id)
+            data_source = _get_data_source(data_source_name_or_id)
         except models.NoResultFound:
             raise Exception("Wrong data source name/id: %s." % data_source_name_or_id)
         schema = data_source.query_runner.get_schema()
@@ -296,15 +453,16 @@ class Python(BaseQueryRunner):
         """
         query = get_query(query_id)
         query_text = query.query_text
-        query_params = set(_collect_query_parameters(query_text))
-        if params is None:
-            query_text = query.query_text
-            missing_params = set(query_params)
-        else:
-            query_text = mustache_render(query.query_text, params)
-            missing_params = set(query_params) - set(params.keys())
-        if len(missing_params) > 0:
-            raise Exception('Missing parameter value for: {}'.format(", ".join(missing_params)))
+        # Queries without any mustache tag have nothing to collect or render.
+        if "{{" in query_text:
+            query_params = _collect_query_parameters(query_text)
+            if params is None:
+                missing_params = query_params
+            else:
+                query_text = mustache_render(query_text, params)
+                missing_params = query_params - params.keys()
+            if len(missing_params) > 0:
+                raise Exception('Missing parameter value for: {}'.format(", ".join(missing_params)))
         data, error = query.data_source.query_runner.run_query(query_text, None)
         if error is not None:
             raise Exception(error)
@@ -313,22 +471,12 @@ class Python(BaseQueryRunner):
 
         result["rows"] = df.to_dict("records")
 
-        for column_name, column_type in df.dtypes.items():
-            if column_type == np.bool:
-                redash_type = TYPE_BOOLEAN
-            elif column_type == np.inexact:
-                redash_type = TYPE_FLOAT
-            elif column_type == np.integer:
-                redash_type = TYPE_INTEGER
-            elif column_type in (np.datetime64, np.dtype('<M8[ns]')):
-                if df.empty:
-                    redash_type = TYPE_DATETIME
-                elif len(df[column_name].head(1).astype(str).loc[0]) > 10:
-                    redash_type = TYPE_DATETIME
-                else:
+        for column_name, dtype in df.dtypes.items():
+            redash_type = _KIND_TO_TYPE.get(dtype.kind, TYPE_STRING)
+            if redash_type == TYPE_DATETIME:
+                values = df[column_name].dropna()
+                if not values.empty and (values.dt.normalize() == values).all():
                     redash_type = TYPE_DATE
-            else:
-                redash_type = TYPE_STRING
 
             self.add_result_column(result, column_name, column_name, redash_type)
 
@@ -340,61 +488,29 @@ class Python(BaseQueryRunner):
 
     def run_query(self, query, user):
         self._current_user = user
+        self._custom_print.lines = []
+        self._custom_print.enable()
 
         try:
             error = None
 
-            code = compile_restricted(query, "<string>", "exec")
-
-            builtins = safe_builtins.copy()
-            builtins["_write_"] = self.custom_write
-            builtins["__import__"] = self.custom_import
-            builtins["_getattr_"] = getattr
-            builtins["getattr"] = getattr
-            builtins["_setattr_"] = setattr
-            builtins["setattr"] = setattr
-            builtins["_getitem_"] = self.custom_get_item
-            builtins["_getiter_"] = self.custom_get_iter
-            builtins["_print_"] = self._custom_print
-            builtins["_unpack_sequence_"] = guarded_unpack_sequence
-            builtins["_iter_unpack_sequence_"] = guarded_iter_unpack_sequence
-            builtins["_inplacevar_"] = self.custom_inplacevar
+            code = _compile_restricted_cached(query)
 
-            # Layer in our own additional set of builtins that we have
-            # considered safe.
-            for key in self.safe_builtins:
-                builtins[key] = __builtins__[key]
+            builtins = self._get_builtins_template().copy()
 
-            restricted_globals = dict(__builtins__=builtins)
-            restricted_globals["get_query_result"] = self.get_query_result
-            restricted_globals["get_source_schema"] = self.get_source_schema
-            restricted_globals["get_current_user"] = self.get_current_user
-            restricted_globals["execute_query"] = self.execute_query
-            restricted_globals["execute_by_query_id"] = self.execute_by_query_id
-            restricted_globals["add_result_column"] = self.add_result_column
-            if pandas_installed:
-                restricted_globals["dataframe_to_result"] = self.dataframe_to_result
-            restricted_globals["add_result_row"] = self.add_result_row
-            restricted_globals["disable_print_log"] = self._custom_print.disable
-            restricted_globals["enable_print_log"] = self._custom_print.enable
-
-            # Supported data types
-            restricted_globals["TYPE_DATETIME"] = TYPE_DATETIME
-            restricted_globals["TYPE_BOOLEAN"] = TYPE_BOOLEAN
-            restricted_globals["TYPE_INTEGER"] = TYPE_INTEGER
-            restricted_globals["TYPE_STRING"] = TYPE_STRING
-            restricted_globals["TYPE_DATE"] = TYPE_DATE
-            restricted_globals["TYPE_FLOAT"] = TYPE_FLOAT
+            restricted_globals = self._restricted_globals_template.copy()
+            restricted_globals["__builtins__"] = builtins
 
             # TODO: Figure out the best way to have a timeout on a script
             #       One option is to use ETA with Celery + timeouts on workers
             #       And replacement of worker process every X requests handled.
 
-            exec(code, restricted_globals, self._script_locals)
+            script_locals = {"result": {"rows": [], "columns": [], "log": []}}
+            exec(code, restricted_globals, script_locals)
 
-            result = self._script_locals["result"]
-            result["log"] = self._custom_print.lines
-            json_data = json_dumps(result)
+            result = script_locals["result"]
+            result["log"] = self._custom_print.get_lines()
+            json_data = _dumps_result(result)
         except Exception as e:
             error = str(type(e)) + " " + str(e)
             json_data = None
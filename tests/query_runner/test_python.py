@@ -1,9 +1,178 @@
-from unittest import TestCase
+import datetime
+import decimal
+from unittest import TestCase, skipUnless
 
-from redash.query_runner.python import Python
+from mock import patch
+
+from redash.query_runner.python import (
+    Python,
+    _collect_query_parameters,
+    _dumps_result,
+    _get_data_source,
+    orjson_installed,
+)
+from redash.utils import json_loads
 
 
 class TestPython(TestCase):
     def test_sorted_safe_builtins(self):
         src = list(Python.safe_builtins)
         assert src == sorted(src), 'Python safe_builtins package not sorted.'
+
+    def test_custom_inplacevar(self):
+        assert Python.custom_inplacevar("+=", 1, 2) == 3
+        assert Python.custom_inplacevar("//=", 7, 2) == 3
+        assert Python.custom_inplacevar("+=", [1], [2]) == [1, 2]
+        with self.assertRaises(Exception):
+            Python.custom_inplacevar("=", 1, 2)
+
+    def test_collect_query_parameters(self):
+        query = "SELECT {{ a }}, {{#b}}{{c}}{{/b}}, {{{d}}}, {{! e}}, {{a}}"
+        assert _collect_query_parameters(query) == {"a", "b", "c"}
+
+        query = "{{#a}}{{#b}}{{#c}}{{d}}{{/c}}{{e}}{{/b}}{{/a}}{{#f}}{{g}}{{/f}}"
+        assert _collect_query_parameters(query) == {"a", "b", "c", "d", "e", "f", "g"}
+
+    def test_collect_query_parameters_skips_inverted_sections(self):
+        query = "SELECT {{a}} {{^b}}{{c}}{{/b}}"
+        assert _collect_query_parameters(query) == {"a"}
+
+    def test_add_result_rows(self):
+        result = {}
+        Python.add_result_row(result, {"a": 1})
+        Python.add_result_rows(result, [{"a": 2}, {"a": 3}])
+        assert result["rows"] == [{"a": 1}, {"a": 2}, {"a": 3}]
+
+    def test_custom_import(self):
+        import json
+
+        runner = Python({"allowedImportModules": "json"})
+        assert runner.custom_import("json") is json
+        with self.assertRaises(Exception):
+            runner.custom_import("os")
+
+    def test_additional_builtins_ignores_unknown_names(self):
+        runner = Python({"additionalBuiltins": "range, no_such_builtin,"})
+        with self.assertLogs("redash.query_runner.python", "WARNING"):
+            builtins = runner._get_builtins_template()
+        assert builtins["range"] is range
+        assert "no_such_builtin" not in builtins
+
+    def test_dataframe_to_result_column_types(self):
+        import pandas as pd
+
+        df = pd.DataFrame(
+            {
+                "flag": [True, False],
+                "count": pd.Series([1, 2], dtype="uint8"),
+                "nullable": pd.Series([1, None], dtype="Int64"),
+                "ratio": [0.5, 1.5],
+                "day": pd.to_datetime(["2020-01-01", None]),
+                "moment": pd.to_datetime(["2020-01-01 10:00", "2020-01-02 00:00"]),
+                "aware": pd.to_datetime(["2020-01-01 10:00", "2020-01-02 00:00"]).tz_localize("UTC"),
+                "empty": pd.to_datetime([None, None]),
+                "name": ["a", "b"],
+            }
+        )
+        result = {}
+        Python({}).dataframe_to_result(result, df)
+
+        types = {c["name"]: c["type"] for c in result["columns"]}
+        assert types == {
+            "flag": "boolean",
+            "count": "integer",
+            "nullable": "integer",
+            "ratio": "float",
+            "day": "date",
+            "moment": "datetime",
+            "aware": "datetime",
+            "empty": "datetime",
+            "name": "string",
+        }
+
+    @patch("redash.query_runner.python.models.DataSource")
+    def test_get_data_source_by_id_or_name(self, data_source):
+        import numpy as np
+
+        _get_data_source(1)
+        data_source.get_by_id.assert_called_once_with(1)
+
+        data_source.reset_mock()
+        _get_data_source(np.int64(2))
+        data_source.get_by_id.assert_called_once_with(2)
+        data_source.get_by_name.assert_not_called()
+
+        data_source.reset_mock()
+        _get_data_source("pg")
+        data_source.get_by_name.assert_called_once_with("pg")
+        data_source.get_by_id.assert_not_called()
+
+    def test_run_query_does_not_leak_between_runs(self):
+        runner = Python({})
+        first = (
+            "print('first')\n"
+            "add_result_column(result, 'a', 'a', TYPE_INTEGER)\n"
+            "add_result_row(result, {'a': 1})\n"
+            "disable_print_log()\n"
+        )
+        data, error = runner.run_query(first, None)
+        assert error is None
+        assert json_loads(data)["rows"] == [{"a": 1}]
+
+        data, error = runner.run_query("print('second')", None)
+        assert error is None
+        result = json_loads(data)
+        assert result["rows"] == []
+        assert result["columns"] == []
+        assert [line.split("] ", 1)[1] for line in result["log"]] == ["second"]
+
+
+class TestDumpsResult(TestCase):
+    def _payload(self):
+        import numpy as np
+
+        return {
+            "rows": [
+                {
+                    "d": datetime.datetime(2020, 1, 1, 1, 2, 3, 456789),
+                    "day": datetime.date(2020, 1, 1),
+                    "f": np.float64(1.5),
+                    "nan": float("nan"),
+                    "s": "caf\u00e9",
+                }
+            ],
+            "columns": [],
+            "log": [],
+        }
+
+    def _dumps_without_orjson(self, result):
+        with patch("redash.query_runner.python.orjson_installed", False):
+            return _dumps_result(result)
+
+    @skipUnless(orjson_installed, "orjson is not installed")
+    def test_orjson_matches_json_dumps(self):
+        payload = self._payload()
+        assert json_loads(_dumps_result(payload)) == json_loads(
+            self._dumps_without_orjson(payload)
+        )
+        assert json_loads(_dumps_result(payload))["rows"][0]["d"] == (
+            "2020-01-01T01:02:03.456"
+        )
+
+    def test_keeps_decimals_exact(self):
+        result = {"rows": [{"n": decimal.Decimal("1.10")}]}
+        assert '"n": 1.10' in _dumps_result(result)
+        assert '"n": 1.10' in self._dumps_without_orjson(result)
+
+    def test_non_string_keys_match(self):
+        result = {"rows": [{1: "a"}]}
+        assert _dumps_result(result) == self._dumps_without_orjson(result)
+
+    def test_numpy_integers_fail_on_both_paths(self):
+        import numpy as np
+
+        result = {"rows": [{"n": np.int64(1)}]}
+        with self.assertRaises(TypeError):
+            _dumps_result(result)
+        with self.assertRaises(TypeError):
+            self._dumps_without_orjson(result)
@@ -1,3 +1,5 @@
+import datetime
+import decimal
 from collections import namedtuple
 from unittest import TestCase
 
@@ -75,6 +77,17 @@ class TestJsonDumps(TestCase):
     def test_handles_binary(self):
         self.assertEqual(json_dumps(memoryview(b"test")), '"74657374"')
 
+    def test_formats_datetime_with_milliseconds(self):
+        value = datetime.datetime(2020, 1, 1, 1, 2, 3, 456789)
+        self.assertEqual(json_dumps(value), '"2020-01-01T01:02:03.456"')
+
+    def test_keeps_decimals_exact(self):
+        self.assertEqual(json_dumps({"n": decimal.Decimal("1.10")}), '{"n": 1.10}')
+
+    def test_handles_nan_and_large_integers(self):
+        self.assertEqual(json_dumps(float("nan")), "null")
+        self.assertEqual(json_dumps(2 ** 70), str(2 ** 70))
+
 
 class TestGenerateToken(TestCase):
     def test_format(self):